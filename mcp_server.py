@@ -1,5 +1,8 @@
 from fastapi import FastAPI, Request
-import os, requests, base64
+from fastapi.responses import ORJSONResponse
+import os, re, sys, base64, random, asyncio
+import httpx
+import orjson
 from dotenv import load_dotenv
 import uvicorn
 
@@ -8,7 +11,7 @@ import uvicorn
 # ---------------------------
 load_dotenv()
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # ---------------------------
 # Azure DevOps Setup
@@ -19,42 +22,99 @@ AZURE_TOKEN = os.getenv("AZURE_TOKEN")
 
 # Ensure org URL doesn't have trailing slash
 AZURE_ORG_URL = AZURE_ORG_URL.rstrip('/')
+AZURE_BASE = f"{AZURE_ORG_URL}/{AZURE_PROJECT}"
 
 AZURE_WORKITEM_URL = f"{AZURE_ORG_URL}/{AZURE_PROJECT}/_apis/wit/workitems/$Issue?api-version=7.0"
+AZURE_BATCH_URL = f"{AZURE_ORG_URL}/_apis/wit/$batch?api-version=7.0"
+AZURE_BATCH_MAX_ITEMS = 200  # Azure DevOps limit per $batch request
+# A full batch can take well over the default 30s; only connecting stays short
+AZURE_BATCH_TIMEOUT = httpx.Timeout(float(os.getenv("AZURE_BATCH_TIMEOUT", "180")), connect=10.0)
 print(f"✅ Azure endpoint: {AZURE_WORKITEM_URL}")
 
+# Title cleanup: markdown heading/bold markers, whitespace runs, and
+# titles that are really acceptance criteria or separators
+# Headings are stripped before bold markers, so "*#*" still loses its "**"
+_HEADING_RE = re.compile(r"#+")
+_BOLD_RE = re.compile(r"\*\*")
+_WS_RE = re.compile(r"\s+")
+_SKIP_RE = re.compile(r"acceptance criteria|---|as a", re.IGNORECASE)
+
+# Description formatting: newlines become <br/>, and a "- " or "* " bullet
+# right after a line break becomes "• " (single pass over the text)
+_DESC_RE = re.compile(r"(?:\n|<br/>)([-*] )?")
+
+def _format_line_break(match):
+    return "<br/>• " if match.group(1) else "<br/>"
+
 # ---------------------------
-# Helper function to get Azure headers
+# Azure auth headers (PAT is constant for the process, so encode once)
 # ---------------------------
-def get_azure_headers():
-    """
-    Creates proper authentication headers for Azure DevOps API.
-    """
-    pat_token = os.getenv("AZURE_TOKEN")
-    auth_string = f":{pat_token}"
-    basic_auth = base64.b64encode(auth_string.encode('utf-8')).decode('utf-8')
-    
-    return {
-        "Authorization": f"Basic {basic_auth}",
-        "Content-Type": "application/json-patch+json"
-    }
+_BASIC_AUTH = base64.b64encode(f":{AZURE_TOKEN}".encode('utf-8')).decode('utf-8')
+
+_AZURE_HEADERS_PATCH = {
+    "Authorization": f"Basic {_BASIC_AUTH}",
+    "Content-Type": "application/json-patch+json"
+}
+
+_AZURE_HEADERS_JSON = {
+    "Authorization": f"Basic {_BASIC_AUTH}",
+    "Content-Type": "application/json"
+}
 
 # ---------------------------
-# Check Azure Auth validity
+# Shared async HTTP client (connection pooling + keep-alive)
 # ---------------------------
-def check_azure_auth():
+# HTTP/2 lets concurrent requests (e.g. many wiki pages) share one TLS connection;
+# the transport retries failed connection attempts. server.py runs these helpers
+# in-process and makes its own Azure calls through this client as well.
+AZURE_CLIENT = httpx.AsyncClient(
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=10, max_keepalive_connections=10)
+    ),
+    timeout=30.0,
+    headers=_AZURE_HEADERS_JSON
+)
+
+# Idempotent GETs are retried when Azure DevOps throttles (429) or fails (5xx)
+AZURE_MAX_RETRIES = 3
+AZURE_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+def azure_retry_delay(response, attempt):
+    """Delay before retrying a throttled or failed Azure GET, honouring Retry-After, or None"""
+    if attempt >= AZURE_MAX_RETRIES or response.status_code not in AZURE_RETRY_STATUSES:
+        return None
     try:
-        headers = get_azure_headers()
-        headers_for_get = {"Authorization": headers["Authorization"]}
+        return min(60, float(response.headers["Retry-After"]))
+    except (KeyError, ValueError):
+        return min(60, 2 ** attempt + random.random())
+
+async def azure_get(client, url):
+    """GET from Azure DevOps with status-based retries; returns the last response"""
+    for attempt in range(AZURE_MAX_RETRIES + 1):
+        res = await client.get(url)
         
+        delay = azure_retry_delay(res, attempt)
+        if delay is None:
+            return res
+        
+        print(f"⏳ Azure returned {res.status_code}, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+# ---------------------------
+# Check Azure Auth validity
+# ---------------------------
+async def check_azure_auth():
+    try:
         test_url = f"{AZURE_ORG_URL}/_apis/projects?api-version=7.0"
         print(f"🔍 Testing auth at: {test_url}")
         
-        res = requests.get(test_url, headers=headers_for_get, allow_redirects=False)
+        res = await azure_get(AZURE_CLIENT, test_url)
         
         if res.status_code == 200:
             print("🔐 Azure DevOps Authentication: OK ✅")
-            projects = res.json()
+            projects = orjson.loads(res.content)
             print(f"📋 Found {projects.get('count', 0)} projects")
             return True
         else:
@@ -65,42 +125,45 @@ def check_azure_auth():
         print(f"❌ Auth check error: {str(e)}")
         return False
 
-check_azure_auth()
+# Run the auth check in the background on startup instead of at import,
+# so workers don't each wait an Azure round-trip before serving
+@app.on_event("startup")
+async def start_auth_check():
+    app.state.auth_check = asyncio.create_task(check_azure_auth())
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await AZURE_CLIENT.aclose()
 
 # ---------------------------
 # Fetch Azure Wiki Page(s)
 # ---------------------------
-@app.post("/tools/fetch_wiki/run")
-async def fetch_wiki(request: Request):
+async def fetch_wiki_content(page_paths):
     """
-    Fetches one or multiple wiki pages from Azure DevOps Wiki
-    Args:
-        page_paths: list of wiki page paths (e.g., ["Wallet-Setup-And-Topup", "Wallet-Payments"])
+    Fetches the given wiki pages concurrently and returns their combined content.
+    Used by the fetch_wiki tool and called in-process by server.py.
     """
-    data = await request.json()
-    page_paths = data.get("args", {}).get("page_paths", [])
-
-    if not page_paths:
-        return {"result": "No page paths provided."}
-
-    headers = get_azure_headers()
-    headers["Content-Type"] = "application/json"
-    
-    combined_content = []
-    
+    urls = []
     for page_path in page_paths:
         wiki_url = f"{AZURE_ORG_URL}/{AZURE_PROJECT}/_apis/wiki/wikis/{AZURE_PROJECT}.wiki/pages?path=/{page_path}&includeContent=true&api-version=7.0"
-        
         print(f"📄 Fetching wiki page: {page_path}")
         print(f"🔗 URL: {wiki_url}")
-        
+        urls.append(wiki_url)
+    
+    # Fetch all pages concurrently; results come back in the same order as page_paths
+    responses = await asyncio.gather(*(azure_get(AZURE_CLIENT, url) for url in urls), return_exceptions=True)
+    
+    combined_content = []
+    
+    for page_path, res in zip(page_paths, responses):
         try:
-            res = requests.get(wiki_url, headers=headers, timeout=30)
-            print(f"📊 Wiki response status: {res.status_code}")
+            if isinstance(res, Exception):
+                raise res
+            
+            print(f"📊 Wiki response status for {page_path}: {res.status_code}")
             
             if res.status_code == 200:
-                result = res.json()
-                content = result.get("content", "")
+                content = orjson.loads(res.content).get("content", "")
                 combined_content.append(f"=== {page_path} ===\n{content}\n")
                 print(f"✅ Fetched {page_path} ({len(content)} chars)")
             else:
@@ -111,42 +174,48 @@ async def fetch_wiki(request: Request):
             print(f"❌ Error fetching {page_path}: {str(e)}")
             combined_content.append(f"=== {page_path} ===\nError: {str(e)}\n")
     
-    return {"result": "\n".join(combined_content)}
+    return "\n".join(combined_content)
+
+@app.post("/tools/fetch_wiki/run")
+async def fetch_wiki(request: Request):
+    """
+    Fetches one or multiple wiki pages from Azure DevOps Wiki
+    Args:
+        page_paths: list of wiki page paths (e.g., ["Wallet-Setup-And-Topup", "Wallet-Payments"])
+    """
+    data = orjson.loads(await request.body())
+    page_paths = data.get("args", {}).get("page_paths", [])
+
+    if not page_paths:
+        return {"result": "No page paths provided."}
+
+    return {"result": await fetch_wiki_content(page_paths)}
 
 # ---------------------------
 # Create Issue in Azure Boards
 # ---------------------------
-@app.post("/tools/create_story/run")
-async def create_story(request: Request):
-    data = await request.json()
-    title = data.get("args", {}).get("title", "")
-    description = data.get("args", {}).get("description", "")
-    epic_id = data.get("args", {}).get("epic_id", None)  # Optional: link to epic
-
+def prepare_work_item(title, description, epic_id=None):
+    """
+    Cleans up a story and builds its JSON-patch payload.
+    Returns (clean_title, payload), or (None, result) if the story is skipped.
+    """
     if not title or not description:
-        return {"result": "Missing title or description."}
+        return None, {"result": "Missing title or description."}
 
     # Clean up title
-    clean_title = title.strip()
-    clean_title = clean_title.replace("###", "").replace("##", "").replace("#", "")
-    clean_title = clean_title.replace("**", "")
-    clean_title = " ".join(clean_title.split())
+    clean_title = _WS_RE.sub(" ", _BOLD_RE.sub("", _HEADING_RE.sub("", title))).strip()
     
     # Skip if title is acceptance criteria or separator
-    skip_keywords = ["acceptance criteria", "---", "as a", "**as"]
-    if any(keyword in clean_title.lower()[:30] for keyword in skip_keywords):
+    if _SKIP_RE.search(clean_title[:30]):
         print(f"⏭️ Skipping non-story item: {clean_title[:50]}")
-        return {"result": f"Skipped: {clean_title[:50]}"}
+        return None, {"result": f"Skipped: {clean_title[:50]}"}
     
     if len(clean_title) < 10:
         print(f"⏭️ Skipping short title: {clean_title}")
-        return {"result": f"Skipped short title: {clean_title}"}
+        return None, {"result": f"Skipped short title: {clean_title}"}
 
     # Format description with proper line breaks and bullets
-    clean_description = description.strip()
-    formatted_description = clean_description.replace("\n", "<br/>")
-    formatted_description = formatted_description.replace("<br/>- ", "<br/>• ")
-    formatted_description = formatted_description.replace("<br/>* ", "<br/>• ")
+    formatted_description = _DESC_RE.sub(_format_line_break, description.strip())
 
     # Create work item payload
     payload = [
@@ -165,34 +234,173 @@ async def create_story(request: Request):
             }
         })
 
-    headers = get_azure_headers()
+    return clean_title, payload
+
+def work_item_result(clean_title, status_code, body):
+    """
+    Turns an Azure create-work-item response (status + JSON body text) into a tool result.
+    """
+    if status_code == 200:
+        result = orjson.loads(body)
+        work_item_id = result.get('id')
+        print(f"✅ Successfully created issue #{work_item_id}")
+        return {
+            "result": f"Successfully created Issue #{work_item_id}: {clean_title[:50]}",
+            "id": work_item_id,
+            "url": result.get('_links', {}).get('html', {}).get('href', '')
+        }
+    else:
+        print(f"⚠️ Unexpected response: {status_code}")
+        print(f"📄 Response Body:\n{body[:1000]}")
+        return {"result": f"Error {status_code}: {body[:500]}"}
 
+async def post_work_item(clean_title, payload):
     print(f"📦 Creating issue: {clean_title[:60]}...")
     print(f"🔗 Posting to: {AZURE_WORKITEM_URL}")
 
     try:
-        r = requests.post(AZURE_WORKITEM_URL, json=payload, headers=headers, allow_redirects=False, timeout=30)
+        r = await AZURE_CLIENT.post(
+            AZURE_WORKITEM_URL,
+            content=orjson.dumps(payload),
+            headers=_AZURE_HEADERS_PATCH
+        )
         
         print(f"📤 Azure Response Status: {r.status_code}")
-        
-        if r.status_code == 200:
-            result = r.json()
-            work_item_id = result.get('id')
-            print(f"✅ Successfully created issue #{work_item_id}")
-            return {
-                "result": f"Successfully created Issue #{work_item_id}: {clean_title[:50]}",
-                "id": work_item_id,
-                "url": result.get('_links', {}).get('html', {}).get('href', '')
-            }
-        else:
-            print(f"⚠️ Unexpected response: {r.status_code}")
-            print(f"📄 Response Body:\n{r.text[:1000]}")
-            return {"result": f"Error {r.status_code}: {r.text[:500]}"}
+        return work_item_result(clean_title, r.status_code, r.text)
             
     except Exception as e:
         print(f"❌ Exception occurred: {str(e)}")
         return {"result": f"Error posting to Azure Boards: {str(e)}"}
 
+async def create_work_item(title, description, epic_id=None):
+    """
+    Creates an Issue in Azure Boards, optionally linked to an epic.
+    Used by the create_story tool and called in-process by server.py.
+    """
+    clean_title, payload = prepare_work_item(title, description, epic_id)
+    if clean_title is None:
+        return payload
+    
+    return await post_work_item(clean_title, payload)
+
+async def create_work_items_batch(stories, epic_id=None):
+    """
+    Creates many Issues through the Azure DevOps work item $batch API
+    (up to 200 per request), falling back to individual creates only when a batch
+    was never applied (connection failed or request rejected). If a batch may have
+    been applied (timeout, gateway error, unreadable response) its stories are
+    reported as unknown instead, so they are never created twice.
+    Args:
+        stories: list of {"title": ..., "description": ...}
+    Returns one result per story, in the same order.
+    """
+    results = [None] * len(stories)
+    to_create = []
+    
+    for idx, story in enumerate(stories):
+        clean_title, payload = prepare_work_item(story.get("title", ""), story.get("description", ""), epic_id)
+        if clean_title is None:
+            results[idx] = payload
+        else:
+            to_create.append((idx, clean_title, payload))
+    
+    for start in range(0, len(to_create), AZURE_BATCH_MAX_ITEMS):
+        chunk = to_create[start:start + AZURE_BATCH_MAX_ITEMS]
+        batch_body = [
+            {
+                "method": "PATCH",
+                "uri": f"/{AZURE_PROJECT}/_apis/wit/workitems/$Issue?api-version=7.0",
+                "headers": {"Content-Type": "application/json-patch+json"},
+                "body": payload
+            }
+            for _, _, payload in chunk
+        ]
+        
+        print(f"📦 Creating {len(chunk)} issues in one batch request")
+        
+        try:
+            r = await AZURE_CLIENT.post(AZURE_BATCH_URL, content=orjson.dumps(batch_body), timeout=AZURE_BATCH_TIMEOUT)
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            r, error = None, e
+        except Exception as e:
+            # The batch was sent, so Azure may have created some or all of the items;
+            # creating them again could duplicate them
+            print(f"❌ Batch create outcome unknown: {str(e)}")
+            for idx, _, _ in chunk:
+                results[idx] = {"status": "unknown", "result": f"Unknown: batch request failed after sending, check Azure Boards before retrying ({str(e)})"}
+            continue
+        
+        if r is not None:
+            print(f"📤 Azure Batch Response Status: {r.status_code}")
+            error = f"Batch request failed ({r.status_code}): {r.text[:500]}"
+            
+            # A gateway 500/502/504 can arrive after Azure already processed the batch
+            if r.status_code >= 500 and r.status_code != 503:
+                print(f"❌ Batch create outcome unknown: {error}")
+                for idx, _, _ in chunk:
+                    results[idx] = {"status": "unknown", "result": f"Unknown: {error}, check Azure Boards before retrying"}
+                continue
+        
+        # Never connected, or rejected outright (4xx/503): nothing was created, so create one by one
+        if r is None or not 200 <= r.status_code < 300:
+            print(f"⚠️ Batch create failed, creating individually: {str(error)}")
+            fallback = await asyncio.gather(
+                *(post_work_item(clean_title, payload) for _, clean_title, payload in chunk)
+            )
+            for (idx, _, _), result in zip(chunk, fallback):
+                results[idx] = result
+            continue
+        
+        try:
+            responses = orjson.loads(r.content).get("value", [])
+            if len(responses) != len(chunk):
+                raise Exception(f"Batch returned {len(responses)} results for {len(chunk)} items")
+        except Exception as e:
+            print(f"❌ Batch create outcome unknown: {str(e)}")
+            for idx, _, _ in chunk:
+                results[idx] = {"status": "unknown", "result": f"Unknown: unreadable batch response, check Azure Boards before retrying ({str(e)})"}
+            continue
+        
+        # Each batch item carries its own status code and (normally) a JSON body as a string
+        for (idx, clean_title, _), item in zip(chunk, responses):
+            try:
+                body = item.get("body", "")
+                if not isinstance(body, str):
+                    body = orjson.dumps(body).decode("utf-8")
+                results[idx] = work_item_result(clean_title, item.get("code"), body)
+            except Exception as e:
+                # The item may well have been created; report it rather than fail the whole batch
+                print(f"❌ Batch item outcome unknown: {str(e)}")
+                results[idx] = {"status": "unknown", "result": f"Unknown: unreadable batch item response, check Azure Boards before retrying ({str(e)})"}
+    
+    return results
+
+@app.post("/tools/create_story/run")
+async def create_story(request: Request):
+    data = orjson.loads(await request.body())
+    title = data.get("args", {}).get("title", "")
+    description = data.get("args", {}).get("description", "")
+    epic_id = data.get("args", {}).get("epic_id", None)  # Optional: link to epic
+
+    return await create_work_item(title, description, epic_id)
+
+@app.post("/tools/create_stories_bulk/run")
+async def create_stories_bulk(request: Request):
+    """
+    Creates many issues in one call via the Azure DevOps $batch API
+    Args:
+        stories: list of {"title": ..., "description": ...}
+        epic_id: optional epic to link every story to
+    """
+    data = orjson.loads(await request.body())
+    stories = data.get("args", {}).get("stories", [])
+    epic_id = data.get("args", {}).get("epic_id", None)
+
+    if not stories:
+        return {"result": []}
+
+    return {"result": await create_work_items_batch(stories, epic_id)}
+
 # ---------------------------
 # Health check endpoint
 # ---------------------------
@@ -215,4 +423,15 @@ async def root():
 if __name__ == "__main__":
     port = int(os.getenv("MCP_PORT", 5001))
     print(f"🚀 Starting MCP server on port {port}")
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    uvicorn.run(
+        "mcp_server:app",
+        host="0.0.0.0",
+        port=port,
+        # uvloop has no Windows build; "auto" falls back to asyncio there
+        loop="auto" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 2) * 2 + 1)),
+        limit_concurrency=int(os.getenv("LIMIT_CONCURRENCY", "256")),
+        access_log=False,
+        proxy_headers=True
+    )
\ No newline at end of file
@@ -1,15 +1,39 @@
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
-import requests
+import httpx
+import asyncio
 import os
-import json
-import base64
+import re
+import sys
+import random
+import orjson
+import ijson
+import shutil
+import tempfile
+try:
+    import fcntl
+except ImportError:  # Windows: no flock; __main__ exports before starting workers
+    fcntl = None
+from functools import lru_cache
+from collections import OrderedDict
+from cachetools import TTLCache
+import numpy as np
+import onnxruntime
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from transformers import AutoTokenizer
 from dotenv import load_dotenv
+import uvicorn
+from mcp_server import (
+    fetch_wiki_content, create_work_items_batch, start_auth_check, close_http_client,
+    azure_get, azure_retry_delay, AZURE_MAX_RETRIES, AZURE_BASE, AZURE_CLIENT
+)
 
 load_dotenv()
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -19,7 +43,70 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-def call_openai(messages, temperature=0.7):
+# The MCP helpers run in-process and this app's Azure calls share their client,
+# so that client's lifecycle is tied to this app too
+app.add_event_handler("startup", start_auth_check)
+app.add_event_handler("shutdown", close_http_client)
+
+# Async client for OpenAI calls; auth headers are passed per call
+_httpx = httpx.AsyncClient(
+    transport=httpx.AsyncHTTPTransport(
+        http2=True,
+        retries=3,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+    ),
+    timeout=60.0
+)
+
+@app.on_event("shutdown")
+async def shutdown():
+    await _httpx.aclose()
+
+# Word tokens for keyword matching of epic titles against page paths
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+# Cap concurrent OpenAI requests per worker; 429/5xx responses are retried with backoff
+OPENAI_SEM = asyncio.Semaphore(int(os.getenv("OPENAI_MAX_CONCURRENT", "8")))
+OPENAI_MAX_RETRIES = 3
+
+# Wiki page lists keyed by project base URL; the page tree changes rarely
+_pages_cache = TTLCache(maxsize=4, ttl=int(os.getenv("WIKI_PAGES_CACHE_TTL", "300")))
+_pages_cache_lock = asyncio.Lock()
+
+# Each worker process has its own cache, so invalidation touches a stamp file
+# and every worker drops its cache once it sees the stamp's mtime change
+# (shared by workers on one host; X-No-Cache bypasses the cache per request)
+WIKI_PAGES_CACHE_STAMP = os.getenv(
+    "WIKI_PAGES_CACHE_STAMP",
+    os.path.join(tempfile.gettempdir(), "azure-story-generator-wiki-pages.stamp")
+)
+_pages_cache_generation = None
+
+# Local sentence embedding model used to match wiki pages to epics
+EMBED_MODEL = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBED_ONNX_DIR = os.getenv("EMBED_ONNX_DIR", "models/minilm-onnx-int8")
+EMBED_ONNX_FILE = os.path.join(EMBED_ONNX_DIR, "model_quantized.onnx")
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "1"))
+EMBED_MATCH_THRESHOLD = float(os.getenv("EMBED_MATCH_THRESHOLD", "0.6"))
+
+# Use GPT-4 instead of the local model to match wiki pages to epics
+USE_LLM_MATCH = os.getenv("USE_LLM_MATCH") == "1"
+
+# Semantic cache of recent GPT-4 epic -> wiki matches, keyed by (page list hash, title).
+# A new title whose embedding is within MATCH_CACHE_THRESHOLD cosine similarity
+# of a cached one over the same page list reuses its matches (LRU, 1024 entries).
+# Only used with USE_LLM_MATCH; local embedding matching is cheaper than a lookup.
+_match_cache = OrderedDict()
+MATCH_CACHE_SIZE = 1024
+MATCH_CACHE_THRESHOLD = float(os.getenv("MATCH_CACHE_THRESHOLD", "0.92"))
+
+def openai_retry_delay(status_code, attempt):
+    """Backoff delay before retrying a rate-limited (429) or failed (5xx) OpenAI call, or None"""
+    if attempt >= OPENAI_MAX_RETRIES or (status_code != 429 and status_code < 500):
+        return None
+    return min(60, 2 ** attempt + random.random())
+
+async def call_openai(messages, temperature=0.7):
     """Direct HTTP call to OpenAI API"""
     headers = {
         "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}",
@@ -32,16 +119,214 @@ def call_openai(messages, temperature=0.7):
         "temperature": temperature
     }
     
-    response = requests.post(
-        "https://api.openai.com/v1/chat/completions",
-        headers=headers,
-        json=payload
+    async with OPENAI_SEM:
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            response = await _httpx.post(
+                "https://api.openai.com/v1/chat/completions",
+                headers=headers,
+                content=orjson.dumps(payload)
+            )
+            
+            if response.status_code == 200:
+                return orjson.loads(response.content)["choices"][0]["message"]["content"]
+            
+            delay = openai_retry_delay(response.status_code, attempt)
+            if delay is None:
+                raise Exception(f"OpenAI API error: {response.status_code}")
+            
+            print(f"⏳ OpenAI returned {response.status_code}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+async def stream_openai(messages, temperature=0.7):
+    """Streaming HTTP call to OpenAI API, yields content deltas as they arrive"""
+    headers = {
+        "Authorization": f"Bearer {os.getenv('OPENAI_API_KEY')}",
+        "Content-Type": "application/json"
+    }
+    
+    payload = {
+        "model": "gpt-4",
+        "messages": messages,
+        "temperature": temperature,
+        "stream": True
+    }
+    
+    async with OPENAI_SEM:
+        for attempt in range(OPENAI_MAX_RETRIES + 1):
+            async with _httpx.stream(
+                "POST",
+                "https://api.openai.com/v1/chat/completions",
+                headers=headers,
+                content=orjson.dumps(payload)
+            ) as response:
+                if response.status_code == 200:
+                    # Server-sent events: one "data: {...}" line per chunk, terminated by "data: [DONE]"
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data: "):
+                            continue
+                        data = line[len("data: "):]
+                        if data == "[DONE]":
+                            break
+                        choices = orjson.loads(data).get("choices") or [{}]
+                        delta = choices[0].get("delta", {}).get("content")
+                        if delta:
+                            yield delta
+                    return
+            
+            # Only retried before anything was streamed, so no output is duplicated
+            delay = openai_retry_delay(response.status_code, attempt)
+            if delay is None:
+                raise Exception(f"OpenAI API error: {response.status_code}")
+            
+            print(f"⏳ OpenAI returned {response.status_code}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+def export_embed_model():
+    """
+    Export and int8-quantize the embedding model into EMBED_ONNX_DIR, once.
+    Workers starting together take a lock beside the model dir: one exports,
+    the rest wait and then load its result. The export is written to a temp dir
+    and renamed into place, so a crashed export never looks complete.
+    """
+    parent = os.path.dirname(os.path.abspath(EMBED_ONNX_DIR))
+    os.makedirs(parent, exist_ok=True)
+    
+    with open(os.path.abspath(EMBED_ONNX_DIR) + ".lock", "w") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        
+        if os.path.isfile(EMBED_ONNX_FILE):
+            return
+        
+        tmp_dir = tempfile.mkdtemp(dir=parent, prefix=".embed-export-")
+        try:
+            print(f"📦 Exporting {EMBED_MODEL} to int8 ONNX at {EMBED_ONNX_DIR}")
+            onnx_model = ORTModelForFeatureExtraction.from_pretrained(EMBED_MODEL, export=True)
+            quantizer = ORTQuantizer.from_pretrained(onnx_model)
+            quantizer.quantize(
+                save_dir=tmp_dir,
+                quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+            )
+            AutoTokenizer.from_pretrained(EMBED_MODEL).save_pretrained(tmp_dir)
+            
+            # Clear out a partial export left by an older version before renaming in
+            shutil.rmtree(EMBED_ONNX_DIR, ignore_errors=True)
+            os.replace(tmp_dir, EMBED_ONNX_DIR)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def load_embed_model():
+    """Load the int8-quantized ONNX embedding model, exporting it on first run"""
+    if not os.path.isfile(EMBED_ONNX_FILE):
+        export_embed_model()
+    
+    # One worker process per core already, so keep each session's thread pool small
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = EMBED_THREADS
+    session_options.inter_op_num_threads = 1
+    
+    tokenizer = AutoTokenizer.from_pretrained(EMBED_ONNX_DIR)
+    model = ORTModelForFeatureExtraction.from_pretrained(
+        EMBED_ONNX_DIR,
+        file_name="model_quantized.onnx",
+        provider="CPUExecutionProvider",
+        session_options=session_options
     )
+    return tokenizer, model
+
+embed_tokenizer, embed_model = None, None
+
+async def load_embed_model_in_background():
+    global embed_tokenizer, embed_model
+    try:
+        embed_tokenizer, embed_model = await asyncio.to_thread(load_embed_model)
+        print("🧠 Embedding model loaded")
+    except Exception as e:
+        print(f"⚠️ Embedding model unavailable, using keyword matching: {str(e)}")
+
+# Loaded per worker in the background after startup (not at import, so the
+# supervisor process never loads it, and not awaited, so the worker serves right
+# away); until it's ready, or if loading fails, matching falls back to keywords
+@app.on_event("startup")
+async def start_embed_model():
+    app.state.embed_model_load = asyncio.create_task(load_embed_model_in_background())
+
+def embed(texts, batch_size=64):
+    """Mean-pooled, L2-normalized sentence embeddings (same as sentence-transformers MiniLM)"""
+    if embed_model is None:
+        raise Exception("embedding model not loaded")
+    
+    vectors = []
+    for i in range(0, len(texts), batch_size):
+        inputs = embed_tokenizer(texts[i:i + batch_size], padding=True, truncation=True, return_tensors="np")
+        hidden = embed_model(**inputs).last_hidden_state
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        vectors.append((hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None))
+    
+    vectors = np.concatenate(vectors)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+@lru_cache(maxsize=4)
+def embed_pages(pages):
+    """
+    Embeddings for a wiki page list. The list only changes when the wiki cache
+    refreshes, so this acts as the page index and each request encodes just the title.
+    """
+    # Page paths are slug-like ("Wallet/Setup-And-Topup"), so turn separators into spaces
+    return embed([page.replace("/", " ").replace("-", " ") for page in pages])
+
+def match_pages_by_embedding(title_vector, all_pages):
+    """Score wiki pages against an embedded epic title by cosine similarity"""
+    scores = embed_pages(tuple(all_pages)) @ title_vector
+    
+    matches = [
+        {"path": page, "confidence": round(float(score), 3), "reason": "Semantic match"}
+        for page, score in zip(all_pages, scores)
+        if score >= EMBED_MATCH_THRESHOLD
+    ]
+    return sorted(matches, key=lambda x: x["confidence"], reverse=True)
+
+def match_cache_get(pages_key, title_vector):
+    """Matches cached for a near-identical epic title over the same page list, or None"""
+    keys = [key for key in _match_cache if key[0] == pages_key]
+    if not keys:
+        return None
+    
+    similarities = np.stack([_match_cache[key][0] for key in keys]) @ title_vector
+    best = int(np.argmax(similarities))
+    if similarities[best] < MATCH_CACHE_THRESHOLD:
+        return None
+    
+    _match_cache.move_to_end(keys[best])
+    return _match_cache[keys[best]][1]
+
+def match_cache_put(pages_key, epic_title, title_vector, matches):
+    key = (pages_key, epic_title)
+    _match_cache[key] = (title_vector, matches)
+    _match_cache.move_to_end(key)
+    while len(_match_cache) > MATCH_CACHE_SIZE:
+        _match_cache.popitem(last=False)
+
+@lru_cache(maxsize=4)
+def page_tokens(pages):
+    """Word sets for a wiki page list, tokenized once per wiki cache refresh"""
+    return [frozenset(_TOKEN_RE.findall(page.casefold())) for page in pages]
+
+def match_pages_by_keywords(epic_title, all_pages):
+    """Fallback matching: fraction of epic title words that appear as words in each page path"""
+    epic_keywords = set(_TOKEN_RE.findall(epic_title.casefold()))
+    if not epic_keywords:
+        return []
+    
+    # Hashed word lookups instead of substring scans; also avoids sub-word
+    # false positives like "pay" matching "Payroll"
+    matches = []
+    for page, tokens in zip(all_pages, page_tokens(tuple(all_pages))):
+        score = len(epic_keywords & tokens) / len(epic_keywords)
+        if score >= 0.3:
+            matches.append({"path": page, "confidence": score, "reason": "Keyword match"})
     
-    if response.status_code == 200:
-        return response.json()["choices"][0]["message"]["content"]
-    else:
-        raise Exception(f"OpenAI API error: {response.status_code}")
+    return sorted(matches, key=lambda x: x["confidence"], reverse=True)
 
 class FindWikiRequest(BaseModel):
     epic_title: str
@@ -53,9 +338,87 @@ class GenerateRequest(BaseModel):
 class EpicRequest(BaseModel):
     epic_id: int
 
+async def fetch_epic(epic_id):
+    """Fetch an Epic work item from Azure DevOps, returns the raw response"""
+    epic_url = f"{AZURE_BASE}/_apis/wit/workitems/{epic_id}?api-version=7.0"
+    print(f"📡 Fetching Epic from: {epic_url}")
+    
+    return await azure_get(AZURE_CLIENT, epic_url)
+
+_MATCH_PROMPT_HEAD = 'You are analyzing which wiki pages are relevant to an Epic.\n\nEpic Title: "'
+_MATCH_PROMPT_MID = '"\n\nAvailable Wiki Pages:\n'
+_MATCH_PROMPT_TAIL = """
+
+Task: Identify which wiki pages are related to this epic and rate each match from 0.0 to 1.0.
+
+Only include pages with confidence >= 0.6.
+
+Response format (JSON):
+{
+  "matches": [
+    {"path": "page-name", "confidence": 0.95, "reason": "why it matches"}
+  ]
+}
+
+Response:"""
+
+async def match_wiki_pages(epic_title, all_pages):
+    """
+    Find wiki pages related to an epic. Uses the local embedding model by default,
+    GPT-4 when USE_LLM_MATCH=1, and keyword matching if either fails.
+    GPT-4 results for near-identical epic titles are served from a semantic cache.
+    """
+    try:
+        # Runs in a thread so encoding doesn't block the event loop
+        title_vector = await asyncio.to_thread(lambda: embed([epic_title])[0])
+    except Exception as e:
+        print(f"⚠️ Embedding epic title failed: {str(e)}")
+        title_vector = None
+    
+    if not (USE_LLM_MATCH and os.getenv('OPENAI_API_KEY')):
+        try:
+            if title_vector is None:
+                raise Exception("no title embedding")
+            
+            matched_pages = await asyncio.to_thread(match_pages_by_embedding, title_vector, all_pages)
+            print(f"🔎 Embedding matched {len(matched_pages)} wiki pages")
+            return matched_pages
+            
+        except Exception as e:
+            print(f"⚠️ Embedding matching failed, using keyword fallback: {str(e)}")
+            return match_pages_by_keywords(epic_title, all_pages)
+    
+    pages_key = hash(tuple(all_pages))
+    
+    if title_vector is not None:
+        cached = match_cache_get(pages_key, title_vector)
+        if cached is not None:
+            print(f"♻️ Reusing {len(cached)} wiki matches from a similar epic")
+            return cached
+    
+    pages_block = "- " + "\n- ".join(all_pages)
+    prompt = _MATCH_PROMPT_HEAD + epic_title + _MATCH_PROMPT_MID + pages_block + _MATCH_PROMPT_TAIL
+    
+    try:
+        response_text = await call_openai([
+            {"role": "system", "content": "You are an expert at matching documentation to project epics."},
+            {"role": "user", "content": prompt}
+        ], temperature=0.3)
+        
+        matched_pages = orjson.loads(response_text).get("matches", [])
+        print(f"🤖 AI matched {len(matched_pages)} wiki pages")
+        
+    except Exception as e:
+        print(f"⚠️ AI matching failed, using keyword fallback: {str(e)}")
+        return match_pages_by_keywords(epic_title, all_pages)
+    
+    if title_vector is not None:
+        match_cache_put(pages_key, epic_title, title_vector, matched_pages)
+    return matched_pages
+
 # NEW ENDPOINT - Complete workflow from Epic ID
 @app.post("/generate_from_epic")
-async def generate_from_epic(request: EpicRequest):
+async def generate_from_epic(request: EpicRequest, http_request: Request):
     """
     Complete workflow: fetch epic title, find wiki pages, generate stories
     All from just an Epic ID
@@ -67,29 +430,22 @@ async def generate_from_epic(request: EpicRequest):
     
     print(f"🎯 Processing Epic #{epic_id}")
     
+    # The Epic lookup and the wiki page list are independent, so fetch both at once
+    epic_res, all_pages = await asyncio.gather(
+        fetch_epic(epic_id),
+        get_all_wiki_pages(use_cache="x-no-cache" not in http_request.headers),
+        return_exceptions=True
+    )
+    
     # Step 1: Get Epic title from Azure DevOps REST API
     try:
-        azure_org = os.getenv("AZURE_ORG_URL").rstrip('/')
-        azure_project = os.getenv("AZURE_PROJECT")
-        azure_token = os.getenv("AZURE_TOKEN")
-        
-        auth_string = f":{azure_token}"
-        basic_auth = base64.b64encode(auth_string.encode('utf-8')).decode('utf-8')
-        
-        headers = {
-            "Authorization": f"Basic {basic_auth}",
-            "Content-Type": "application/json"
-        }
-        
-        epic_url = f"{azure_org}/{azure_project}/_apis/wit/workitems/{epic_id}?api-version=7.0"
-        print(f"📡 Fetching Epic from: {epic_url}")
-        
-        epic_res = requests.get(epic_url, headers=headers, timeout=30)
+        if isinstance(epic_res, Exception):
+            raise epic_res
         
         if epic_res.status_code != 200:
             return {"error": f"Failed to fetch Epic: {epic_res.status_code}"}
         
-        epic_data = epic_res.json()
+        epic_data = orjson.loads(epic_res.content)
         epic_title = epic_data.get("fields", {}).get("System.Title", "")
         
         if not epic_title:
@@ -103,61 +459,13 @@ async def generate_from_epic(request: EpicRequest):
     
     # Step 2: Find related wiki pages
     try:
-        all_pages = await get_all_wiki_pages()
+        if isinstance(all_pages, Exception):
+            raise all_pages
         
         if not all_pages:
             return {"error": "No wiki pages found in project", "story_count": 0}
         
-        # Use AI to match pages if OpenAI key available, otherwise use keyword matching
-        if os.getenv('OPENAI_API_KEY'):
-            prompt = f"""You are analyzing which wiki pages are relevant to an Epic.
-
-Epic Title: "{epic_title}"
-
-Available Wiki Pages:
-{chr(10).join(f"- {page}" for page in all_pages)}
-
-Task: Identify which wiki pages are related to this epic and rate each match from 0.0 to 1.0.
-
-Only include pages with confidence >= 0.6.
-
-Response format (JSON):
-{{
-  "matches": [
-    {{"path": "page-name", "confidence": 0.95, "reason": "why it matches"}}
-  ]
-}}
-
-Response:"""
-
-            try:
-                response_text = call_openai([
-                    {"role": "system", "content": "You are an expert at matching documentation to project epics."},
-                    {"role": "user", "content": prompt}
-                ], temperature=0.3)
-                
-                result = json.loads(response_text)
-                matched_pages = result.get("matches", [])
-                print(f"🤖 AI matched {len(matched_pages)} wiki pages")
-                
-            except Exception as e:
-                print(f"⚠️ AI matching failed, using keyword fallback: {str(e)}")
-                matched_pages = []
-                epic_keywords = epic_title.lower().split()
-                for page in all_pages:
-                    page_lower = page.lower()
-                    score = sum(1 for word in epic_keywords if word in page_lower) / len(epic_keywords)
-                    if score >= 0.3:
-                        matched_pages.append({"path": page, "confidence": score})
-        else:
-            # Keyword matching fallback
-            matched_pages = []
-            epic_keywords = epic_title.lower().split()
-            for page in all_pages:
-                page_lower = page.lower()
-                score = sum(1 for word in epic_keywords if word in page_lower) / len(epic_keywords)
-                if score >= 0.3:
-                    matched_pages.append({"path": page, "confidence": score})
+        matched_pages = await match_wiki_pages(epic_title, all_pages)
         
         if not matched_pages:
             return {"error": "No related wiki pages found for this Epic", "story_count": 0}
@@ -193,138 +501,128 @@ Response:"""
 
 
 @app.post("/find_wiki_pages")
-async def find_wiki_pages(request: FindWikiRequest):
+async def find_wiki_pages(request: FindWikiRequest, http_request: Request):
     print(f"🔍 Finding wiki pages for: {request.epic_title}")
     
     try:
-        all_pages = await get_all_wiki_pages()
+        all_pages = await get_all_wiki_pages(use_cache="x-no-cache" not in http_request.headers)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch wiki pages: {str(e)}")
     
     if not all_pages:
         return {"pages": []}
     
-    prompt = f"""You are analyzing which wiki pages are relevant to an Epic.
-
-Epic Title: "{request.epic_title}"
-
-Available Wiki Pages:
-{chr(10).join(f"- {page}" for page in all_pages)}
-
-Task: Identify which wiki pages are related to this epic and rate each match from 0.0 to 1.0.
+    pages = await match_wiki_pages(request.epic_title, all_pages)
+    
+    print(f"✅ Found {len(pages)} related wiki pages")
+    return {"pages": pages}
 
-Only include pages with confidence >= 0.6.
 
-Response format (JSON):
-{{
-  "matches": [
-    {{"path": "page-name", "confidence": 0.95, "reason": "why it matches"}}
-  ]
-}}
+class _AsyncBodyReader:
+    """Adapts an httpx streaming response to the async read() interface ijson expects"""
+    
+    def __init__(self, response):
+        self._chunks = response.aiter_bytes()
+    
+    async def read(self, size=-1):
+        return await anext(self._chunks, b"")
 
-Response:"""
 
+def pages_cache_generation():
     try:
-        response_text = call_openai([
-            {"role": "system", "content": "You are an expert at matching documentation to project epics."},
-            {"role": "user", "content": prompt}
-        ], temperature=0.3)
-        
-        result = json.loads(response_text)
-        pages = result.get("matches", [])
-        
-        print(f"✅ Found {len(pages)} related wiki pages")
-        return {"pages": pages}
-        
-    except Exception as e:
-        print(f"❌ AI matching failed: {str(e)}")
-        matched = []
-        epic_keywords = request.epic_title.lower().split()
-        for page in all_pages:
-            page_lower = page.lower()
-            score = sum(1 for word in epic_keywords if word in page_lower) / len(epic_keywords)
-            if score >= 0.3:
-                matched.append({"path": page, "confidence": score, "reason": "Keyword match"})
+        return os.stat(WIKI_PAGES_CACHE_STAMP).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def sync_pages_cache():
+    """Drop this worker's cached page lists if any worker invalidated since they were stored"""
+    global _pages_cache_generation
+    generation = pages_cache_generation()
+    if generation != _pages_cache_generation:
+        _pages_cache.clear()
+        _pages_cache_generation = generation
+
+
+async def get_all_wiki_pages(use_cache=True):
+    cache_key = AZURE_BASE
+    sync_pages_cache()
+    if use_cache:
+        cached = _pages_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    
+    # Concurrent cache misses wait for a single fetch instead of each hitting Azure
+    async with _pages_cache_lock:
+        if use_cache:
+            cached = _pages_cache.get(cache_key)
+            if cached is not None:
+                return cached
         
-        return {"pages": sorted(matched, key=lambda x: x["confidence"], reverse=True)}
+        all_paths = await fetch_all_wiki_pages()
+        _pages_cache[cache_key] = all_paths
+        return all_paths
 
 
-async def get_all_wiki_pages():
-    azure_org = os.getenv("AZURE_ORG_URL")
-    azure_project = os.getenv("AZURE_PROJECT")
-    azure_token = os.getenv("AZURE_TOKEN")
-    
-    auth_string = f":{azure_token}"
-    basic_auth = base64.b64encode(auth_string.encode('utf-8')).decode('utf-8')
-    
-    headers = {
-        "Authorization": f"Basic {basic_auth}",
-        "Content-Type": "application/json"
-    }
-    
-    wiki_url = f"{azure_org}/{azure_project}/_apis/wiki/wikis?api-version=7.0"
-    res = requests.get(wiki_url, headers=headers)
+async def fetch_all_wiki_pages():
+    res = await azure_get(AZURE_CLIENT, f"{AZURE_BASE}/_apis/wiki/wikis?api-version=7.0")
     
     if res.status_code != 200:
         raise Exception(f"Failed to get wikis: {res.status_code}")
     
-    wikis = res.json().get("value", [])
+    wikis = orjson.loads(res.content).get("value", [])
     if not wikis:
         return []
     
     wiki_id = wikis[0]["id"]
     
-    pages_url = f"{azure_org}/{azure_project}/_apis/wiki/wikis/{wiki_id}/pages?recursionLevel=full&api-version=7.0"
-    res = requests.get(pages_url, headers=headers)
-    
-    if res.status_code != 200:
-        raise Exception(f"Failed to get pages: {res.status_code}")
-    
-    def extract_paths(page_data):
-        paths = []
-        if "path" in page_data:
-            paths.append(page_data["path"].strip("/"))
-        if "subPages" in page_data:
-            for subpage in page_data["subPages"]:
-                paths.extend(extract_paths(subpage))
-        return paths
+    pages_url = f"{AZURE_BASE}/_apis/wiki/wikis/{wiki_id}/pages?recursionLevel=full&api-version=7.0"
+    # Stream the (potentially large) page tree and pull out only the path
+    # strings, instead of materializing the whole nested dict
+    all_paths = []
+    for attempt in range(AZURE_MAX_RETRIES + 1):
+        async with AZURE_CLIENT.stream("GET", pages_url) as res:
+            if res.status_code == 200:
+                async for prefix, event, value in ijson.parse(_AsyncBodyReader(res)):
+                    if event == "string" and (prefix == "path" or prefix.endswith(".path")):
+                        all_paths.append(value.lstrip("/"))
+                break
+        
+        delay = azure_retry_delay(res, attempt)
+        if delay is None:
+            raise Exception(f"Failed to get pages: {res.status_code}")
+        
+        print(f"⏳ Azure returned {res.status_code}, retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
     
-    data = res.json()
-    all_paths = extract_paths(data)
+    # Pages listed under several parents show up more than once; dedupe once here
+    # so prompts and matching don't pay for duplicates, and keep a stable order
+    all_paths = sorted(set(all_paths))
     
     print(f"📚 Found {len(all_paths)} wiki pages total")
     return all_paths
 
 
+@app.post("/admin/invalidate_cache")
+async def invalidate_cache():
+    # Bump the shared stamp so every worker drops its cache, not just this one
+    with open(WIKI_PAGES_CACHE_STAMP, "a"):
+        os.utime(WIKI_PAGES_CACHE_STAMP)
+    sync_pages_cache()
+    return {"status": "ok", "message": "Wiki page cache cleared"}
+
+
 @app.post("/generate_stories")
 async def generate_stories(request: GenerateRequest):
     print(f"📖 Generating stories from {len(request.wiki_page_paths)} wiki pages")
     
-    # MCP server runs on port 5001
-    mcp_port = int(os.getenv("MCP_PORT", "5001"))
-    
-    print(f"🔗 Calling MCP server at localhost:{mcp_port}")
-    
-    # Fetch wiki content
+    # Fetch wiki content in-process (no loopback HTTP hop to the MCP server)
     try:
-        wiki_response = requests.post(
-            f"http://127.0.0.1:{mcp_port}/tools/fetch_wiki/run",
-            json={"args": {"page_paths": request.wiki_page_paths}},
-            timeout=30
-        )
-        
-        if wiki_response.status_code != 200:
-            raise HTTPException(
-                status_code=500, 
-                detail=f"Failed to fetch wiki pages: {wiki_response.status_code}"
-            )
-        
-        wiki_content = wiki_response.json().get("result", "")
-        
-    except requests.exceptions.RequestException as e:
+        wiki_content = await fetch_wiki_content(request.wiki_page_paths)
+    except Exception as e:
         raise HTTPException(
             status_code=500, 
-            detail=f"Could not connect to MCP server: {str(e)}"
+            detail=f"Failed to fetch wiki pages: {str(e)}"
         )
     
     if "Error" in wiki_content or not wiki_content:
@@ -351,94 +649,120 @@ Wiki Content:
 
 Generate stories now:"""
 
+    # Stories are created through Azure's $batch API. While the LLM is still
+    # streaming, whatever stories completed since the last batch are sent as
+    # soon as the previous batch returns (group commit), so creation overlaps
+    # generation without one request per story.
+    stories = []
+    pending = []
+    batches = []
+    
+    async def _create_batch(batch):
+        print(f"📤 Creating stories {batch[0][0]}-{batch[-1][0]}")
+        
+        try:
+            results = await create_work_items_batch(
+                [story for _, story in batch],
+                request.epic_id
+            )
+            print(f"✅ Stories {batch[0][0]}-{batch[-1][0]} created")
+            return [
+                {"title": story["title"], "status": result.get("status", "created"), "result": result.get("result", "")}
+                for (_, story), result in zip(batch, results)
+            ]
+            
+        except Exception as e:
+            print(f"❌ Stories {batch[0][0]}-{batch[-1][0]} error: {str(e)}")
+            return [
+                {"title": story["title"], "status": "failed", "error": str(e)}
+                for _, story in batch
+            ]
+    
+    def _flush(force=False):
+        if pending and (force or not batches or batches[-1].done()):
+            task = asyncio.create_task(_create_batch(list(pending)))
+            # Send whatever piled up during this batch as soon as it returns,
+            # rather than waiting for the next story to arrive
+            task.add_done_callback(lambda _: _flush())
+            batches.append(task)
+            pending.clear()
+    
+    buffer = ""
+    cut = False  # buffer starts right after an ---END--- that was already parsed
+    
     try:
-        llm_output = call_openai([
+        async for delta in stream_openai([
             {"role": "system", "content": "You are a product manager who writes clear user stories."},
             {"role": "user", "content": prompt}
-        ], temperature=0.7)
+        ], temperature=0.7):
+            # Only the new text (plus a marker-length overlap) can hold a new ---END---
+            scan_from = max(0, len(buffer) - len("---END---") + 1)
+            buffer += delta
+            
+            # Parse every complete block received so far in one pass
+            end = buffer.rfind("---END---", scan_from)
+            if end != -1:
+                end += len("---END---")
+                complete = buffer[:end]
+                if cut:
+                    # Text after an ---END--- and before the next ---STORY--- is
+                    # the tail of an already-parsed block, not a story of its own
+                    start = complete.find("---STORY---")
+                    complete = complete[start:] if start != -1 else ""
+                for story in parse_stories(complete):
+                    stories.append(story)
+                    pending.append((len(stories), story))
+                buffer = buffer[end:]
+                cut = True
+                _flush()
         
         print(f"✅ LLM generated response")
         
     except Exception as e:
+        # Let stories that were already started finish before failing the request
+        pending.clear()
+        await asyncio.gather(*batches)
         raise HTTPException(status_code=500, detail=f"LLM generation failed: {str(e)}")
     
-    stories = parse_stories(llm_output)
     print(f"📋 Parsed {len(stories)} user stories")
     
-    created_stories = []
+    _flush(force=True)
     
-    for idx, story in enumerate(stories, 1):
-        print(f"📤 Creating story {idx}/{len(stories)}")
-        
-        try:
-            azure_response = requests.post(
-                f"http://127.0.0.1:{mcp_port}/tools/create_story/run",
-                json={
-                    "args": {
-                        "title": story["title"],
-                        "description": story["description"],
-                        "epic_id": request.epic_id
-                    }
-                },
-                timeout=30
-            )
-            
-            if azure_response.status_code == 200:
-                result = azure_response.json().get("result", "")
-                created_stories.append({
-                    "title": story["title"],
-                    "status": "created",
-                    "result": result
-                })
-                print(f"✅ Story {idx} created")
-            else:
-                created_stories.append({
-                    "title": story["title"],
-                    "status": "failed",
-                    "error": azure_response.text
-                })
-                print(f"❌ Story {idx} failed")
-                
-        except requests.exceptions.RequestException as e:
-            created_stories.append({
-                "title": story["title"],
-                "status": "failed",
-                "error": str(e)
-            })
-            print(f"❌ Story {idx} error: {str(e)}")
+    # Batches are kept in submission order, so created_stories follows the LLM output order
+    created_stories = [story for batch in await asyncio.gather(*batches) for story in batch]
     
     return {
-        "message": f"Generated {len(stories)} stories",
+        "message": f"Generated {len(created_stories)} stories",
         "stories": created_stories
     }
 
 
+# Story fields, anchored at line starts like the LLM output format: TITLE: lines,
+# the DESCRIPTION: marker line, and non-blank description lines (stripped) that
+# aren't themselves marker lines
+_TITLE_LINE_RE = re.compile(r"^[^\S\n]*TITLE:(.*)", re.M)
+_DESCRIPTION_LINE_RE = re.compile(r"^[^\S\n]*DESCRIPTION:.*", re.M)
+_BODY_LINE_RE = re.compile(r"^[^\S\n]*(?!TITLE:|DESCRIPTION:)(\S.*?)[^\S\n]*$", re.M)
+
 def parse_stories(llm_output: str) -> list:
+    # Marker scan with str.split/partition and line-anchored regexes (C-level
+    # searches) instead of a per-line Python loop over every block
     stories = []
-    story_blocks = llm_output.split("---STORY---")
     
-    for block in story_blocks:
-        if "---END---" not in block:
+    for block in llm_output.split("---STORY---"):
+        content, found, _ = block.partition("---END---")
+        if not found:
             continue
-            
-        content = block.split("---END---")[0].strip()
-        lines = content.split("\n")
-        title = ""
-        description_lines = []
-        in_description = False
         
-        for line in lines:
-            line = line.strip()
-            if line.startswith("TITLE:"):
-                title = line.replace("TITLE:", "").strip()
-            elif line.startswith("DESCRIPTION:"):
-                in_description = True
-            elif in_description and line:
-                description_lines.append(line)
+        # The last TITLE: line wins; the DESCRIPTION: line itself carries no text
+        titles = _TITLE_LINE_RE.findall(content)
+        title = titles[-1].replace("TITLE:", "").strip() if titles else ""
+        
+        marker = _DESCRIPTION_LINE_RE.search(content)
+        description_lines = _BODY_LINE_RE.findall(content, marker.end()) if marker else []
         
         if title and description_lines:
-            description = "\n".join(description_lines)
-            stories.append({"title": title, "description": description})
+            stories.append({"title": title, "description": "\n".join(description_lines)})
     
     return stories
 
@@ -455,4 +779,23 @@ async def root():
     return {
         "status": "running",
         "service": "Story Generator API"
-    }
\ No newline at end of file
+    }
+
+if __name__ == "__main__":
+    port = int(os.getenv("PORT", 8000))
+    # Export the embedding model once up front instead of in the workers
+    if not os.path.isfile(EMBED_ONNX_FILE):
+        export_embed_model()
+    print(f"🚀 Starting Story Generator API on port {port}")
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=port,
+        # uvloop has no Windows build; "auto" falls back to asyncio there
+        loop="auto" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 2) * 2 + 1)),
+        limit_concurrency=int(os.getenv("LIMIT_CONCURRENCY", "256")),
+        access_log=False,
+        proxy_headers=True
+    )
\ No newline at end of file